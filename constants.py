@@ -2,6 +2,25 @@
 """
 本模块用于存放课程表插件的常量
 """
+import os
+from datetime import timezone, timedelta
+
+# --- Time ---
+SHANGHAI_TZ = timezone(timedelta(hours=8))  # 课程时间统一使用上海时区 (UTC+8)
+
+# --- Binding ---
+BIND_TIMEOUT = 60  # 绑定请求的有效期（秒）
+
+# --- User Data ---
+USER_DATA_FLUSH_DELAY = 2  # 用户数据延迟写入的合并窗口（秒）
+
+# --- ICS Parsing ---
+ICS_CACHE_SUFFIX = ".cache.pkl"  # 课表解析结果磁盘缓存文件的后缀
+ICS_HORIZON_DAYS = 365  # 默认展开重复课程的天数（从今天起）
+
+# --- Image Output ---
+RENDER_WORKERS = min(4, os.cpu_count() or 1)  # 图片渲染线程数
+IMAGE_FORMAT = "WEBP"  # 生成图片的格式，可选 WEBP / PNG；Pillow 不支持 WebP 时自动使用 PNG
 
 # --- Group Schedule Image Styles ---
 GS_BG_COLOR = "#FFFFFF"
@@ -40,4 +59,14 @@ RANKING_WIDTH = 900
 RANKING_PADDING = 60
 RANKING_HEADER_HEIGHT = 160
 RANKING_ROW_HEIGHT = 120
-RANKING_AVATAR_SIZE = 80
\ No newline at end of file
+RANKING_AVATAR_SIZE = 80
+
+# --- Avatar ---
+AVATAR_CACHE_TTL = 600  # 头像缓存有效期（秒）
+AVATAR_CACHE_SIZE = 128  # 内存中缓存的原始头像数量
+AVATAR_DISK_CACHE_TTL = 86400  # 磁盘头像缓存有效期（秒）
+AVATAR_IMAGE_CACHE_SIZE = 256  # 已处理头像图片的缓存数量
+AVATAR_RESAMPLE = "BICUBIC"  # 头像缩放滤波器，可选 NEAREST / BILINEAR / BICUBIC / LANCZOS
+
+# --- Text ---
+SANITIZE_CACHE_SIZE = 1024  # 已清洗文本的缓存数量
@@ -3,14 +3,39 @@
 本模块负责插件的数据管理，包括文件路径管理和用户数据的加载与保存。
 """
 import json
+import os
+from itertools import chain
 from pathlib import Path
-from typing import Dict
+from typing import Dict, Optional, Tuple
 
 from astrbot.core.star import StarTools
 
+from .constants import ICS_CACHE_SUFFIX
+
 
 from astrbot.core.star import StarMetadata
 
+try:
+    import orjson
+except ImportError:  # orjson 不可用时回退到标准库 json
+    orjson = None
+
+
+def _loads(data: bytes) -> Dict:
+    """反序列化 JSON 数据，优先使用 orjson"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _dumps(data: Dict) -> bytes:
+    """序列化 JSON 数据，优先使用 orjson"""
+    if orjson is not None:
+        return orjson.dumps(
+            data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
+        )
+    return json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+
 
 class DataManager:
     """数据管理类"""
@@ -18,30 +43,82 @@ class DataManager:
     def __init__(self, meta: StarMetadata):
         self.data_path: Path = StarTools.get_data_dir(meta.name)
         self.ics_path: Path = self.data_path / "ics"
+        self.avatar_path: Path = self.data_path / "avatars"
         self.user_data_file: Path = self.data_path / "userdata.json"
+        self._cache: Optional[Dict] = None
+        self._cache_mtime: float = 0.0
+        self._path_cache: Dict[Tuple[str, str], str] = {}
         self._init_data()
 
     def _init_data(self):
         """初始化插件数据文件和目录"""
         self.data_path.mkdir(parents=True, exist_ok=True)
         self.ics_path.mkdir(exist_ok=True)
+        self.avatar_path.mkdir(exist_ok=True)
         if not self.user_data_file.exists():
-            with open(self.user_data_file, "w", encoding="utf-8") as f:
-                json.dump({}, f)
+            with open(self.user_data_file, "wb") as f:
+                f.write(_dumps({}))
 
     def load_user_data(self) -> Dict:
-        """加载用户数据"""
+        """加载用户数据，文件未被修改时直接返回内存中的缓存"""
         try:
-            with open(self.user_data_file, "r", encoding="utf-8") as f:
-                return json.load(f)
+            mtime = self.user_data_file.stat().st_mtime
+            if self._cache is not None and mtime == self._cache_mtime:
+                return self._cache
+            with open(self.user_data_file, "rb") as f:
+                self._cache = _loads(f.read())
+            self._cache_mtime = mtime
+            return self._cache
         except (FileNotFoundError, json.JSONDecodeError):
             return {}
 
-    def save_user_data(self, user_data: Dict):
-        """保存用户数据"""
-        with open(self.user_data_file, "w", encoding="utf-8") as f:
-            json.dump(user_data, f, ensure_ascii=False, indent=4)
+    def dump_user_data(self, user_data: Dict) -> bytes:
+        """序列化用户数据，可在事件循环中调用以获得一致的快照"""
+        return _dumps(user_data)
+
+    def save_user_data(self, user_data: Dict, data: Optional[bytes] = None):
+        """保存用户数据，先写入临时文件再原子替换，避免写入中断导致文件损坏
+
+        data 为预先序列化的快照，为空时在此处序列化 user_data。
+        """
+        if data is None:
+            data = _dumps(user_data)
+        tmp_file = self.user_data_file.with_suffix(".json.tmp")
+        with open(tmp_file, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.user_data_file)
+        self._cache = user_data
+        self._cache_mtime = self.user_data_file.stat().st_mtime
+
+    def get_ics_file_path(self, user_id: str, group_id: str) -> str:
+        """获取用户的 ICS 文件路径（字符串，可直接用作解析缓存键）"""
+        key = (user_id, group_id)
+        path = self._path_cache.get(key)
+        if path is None:
+            path = self._path_cache[key] = os.fspath(
+                self.ics_path / f"{user_id}_{group_id}.ics"
+            )
+        return path
+
+    def save_ics_file(self, user_id: str, group_id: str, content: str) -> str:
+        """保存用户的 ICS 文件内容，返回文件路径"""
+        ics_file_path = self.get_ics_file_path(user_id, group_id)
+        with open(ics_file_path, "w", encoding="utf-8") as f:
+            f.write(content)
+        self.clear_ics_cache(ics_file_path)
+        return ics_file_path
 
-    def get_ics_file_path(self, user_id: str, group_id: str) -> Path:
-        """获取用户的 ICS 文件路径"""
-        return self.ics_path / f"{user_id}_{group_id}.ics"
+    def clear_ics_cache(self, ics_file_path: str):
+        """删除 ICS 文件对应的各展开天数的解析结果磁盘缓存及残留的临时文件，重新绑定课表后调用"""
+        ics_file = Path(ics_file_path)
+        pattern = f"{ics_file.name}.*d{ICS_CACHE_SUFFIX}"
+        for cache_file in chain(
+            ics_file.parent.glob(pattern), ics_file.parent.glob(f"{pattern}*.tmp")
+        ):
+            try:
+                cache_file.unlink()
+            except OSError:
+                # 残留的缓存文件会因文件状态不一致而失效，删除失败不影响绑定
+                pass
@@ -2,151 +2,422 @@
 """
 本模块负责处理 .ics 文件和 WakeUp 口令的解析、转换和数据获取。
 """
+import functools
 import json
+import operator
+import os
+import pickle
 import re
-from datetime import datetime, timezone, timedelta, date, time as dt_time
-from typing import Dict, List, Optional
+import tempfile
+from dataclasses import dataclass
+from datetime import datetime, timezone, timedelta, date, time as dt_time, tzinfo
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
 import aiohttp
 from icalendar import Calendar, Event
 from dateutil.rrule import rrulestr
 
 from astrbot.api import logger
+from .constants import ICS_CACHE_SUFFIX, ICS_HORIZON_DAYS, SHANGHAI_TZ
+
+# WakeUp 分享口令：「」 包裹的 32 位十六进制串
+_WAKEUP_TOKEN_RE = re.compile(r"「([a-f0-9]{32})」")
+_WAKEUP_TOKEN_MIN_LEN = 34
+# 磁盘缓存格式版本，课程记录结构变化时递增以使旧缓存失效
+_DISK_CACHE_VERSION = 2
+
+
+@dataclass(slots=True)
+class Course:
+    """一节课程。user_id/nickname 由查询群友课表时补充"""
+
+    summary: Optional[str]
+    description: Optional[str]
+    location: Optional[str]
+    start_time: Optional[datetime]
+    end_time: Optional[datetime]
+    start_ts: int = 0
+    end_ts: int = 0
+    user_id: str = ""
+    nickname: str = ""
+
+
+def _load_disk_cache(cache_path: str, stamp: tuple) -> Optional[List[Course]]:
+    """读取磁盘上的解析结果，文件状态或解析日期不一致时返回 None"""
+    try:
+        with open(cache_path, "rb") as f:
+            cached = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"课表缓存 {cache_path} 读取失败，将重新解析: {e}")
+        return None
+    if not isinstance(cached, dict) or cached.get("stamp") != stamp:
+        return None
+    return cached.get("courses")
+
+
+def _save_disk_cache(cache_path: str, stamp: tuple, courses: List[Course]) -> None:
+    """将解析结果写入磁盘缓存，写入失败不影响本次解析结果"""
+    tmp_path = None
+    try:
+        # 同一文件可能在多个线程中同时解析，临时文件名需各不相同
+        fd, tmp_path = tempfile.mkstemp(
+            prefix=os.path.basename(cache_path) + ".",
+            suffix=".tmp",
+            dir=os.path.dirname(cache_path),
+        )
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(
+                {"stamp": stamp, "courses": courses},
+                f,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+        os.replace(tmp_path, cache_path)
+    except Exception as e:
+        logger.warning(f"课表缓存 {cache_path} 写入失败: {e}")
+        if tmp_path is not None:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+
+@functools.lru_cache(maxsize=512)
+def _parse_ics_cached(
+    file_path: str, mtime_ns: int, size: int, horizon_days: int, today_ordinal: int
+) -> List[Course]:
+    """解析 .ics 文件，结果按路径、文件修改时间和当天日期缓存，文件被重写或跨天后自动失效
+
+    内存缓存未命中时（例如重启后）先尝试读取同目录下的磁盘缓存，
+    解析结果依赖当天日期，因此磁盘缓存同时校验解析日期。
+    """
+    cache_path = f"{file_path}.{horizon_days}d{ICS_CACHE_SUFFIX}"
+    stamp = (_DISK_CACHE_VERSION, mtime_ns, size, today_ordinal)
+    courses = _load_disk_cache(cache_path, stamp)
+    if courses is not None:
+        return courses
+
+    courses = _expand_ics(file_path, horizon_days, date.fromordinal(today_ordinal))
+    _save_disk_cache(cache_path, stamp, courses)
+    return courses
+
+
+@functools.lru_cache(maxsize=512)
+def _courses_by_date(
+    file_path: str, mtime_ns: int, size: int, horizon_days: int, today_ordinal: int
+) -> Dict[date, List[Course]]:
+    """按上课日期为解析结果建立索引，每天的课程按开始时间排序，便于二分查找"""
+    by_date: Dict[date, List[Course]] = {}
+    for course in _parse_ics_cached(
+        file_path, mtime_ns, size, horizon_days, today_ordinal
+    ):
+        by_date.setdefault(course.start_time.date(), []).append(course)
+    start_ts = operator.attrgetter("start_ts")
+    for bucket in by_date.values():
+        bucket.sort(key=start_ts)
+    return by_date
+
+
+# 只关心的 VEVENT 属性，其余属性直接跳过
+_VEVENT_FIELDS = frozenset(
+    ("SUMMARY", "DESCRIPTION", "LOCATION", "DTSTART", "DTEND", "RRULE")
+)
+_ICS_TEXT_ESCAPE_RE = re.compile(r"\\([\\;,nN])")
+# RRULE 中的 UNTIL，可能是日期、本地时间或 UTC 时间
+_RRULE_UNTIL_RE = re.compile(r"UNTIL=(\d{8})(?:T(\d{6}))?(Z?)", re.IGNORECASE)
+
+
+def _unescape_text(value: str) -> str:
+    """还原 TEXT 类型属性中的转义字符"""
+    if "\\" not in value:
+        return value
+    return _ICS_TEXT_ESCAPE_RE.sub(
+        lambda m: "\n" if m.group(1) in "nN" else m.group(1), value
+    )
+
+
+def _unfold_lines(text: str) -> Iterator[str]:
+    """合并折行（以空格或制表符开头的续行）"""
+    current = None
+    for line in text.splitlines():
+        if line[:1] in (" ", "\t") and current is not None:
+            current += line[1:]
+            continue
+        if current:
+            yield current
+        current = line
+    if current:
+        yield current
+
+
+def _until_to_utc(match: "re.Match") -> str:
+    """将本地时间或日期形式的 UNTIL 按上海时区换算为 UTC"""
+    if match.group(3):
+        return match.group(0)
+    d = match.group(1)
+    t = match.group(2) or "235959"  # 仅有日期时包含当天全天
+    until_local = datetime(
+        int(d[0:4]), int(d[4:6]), int(d[6:8]),
+        int(t[0:2]), int(t[2:4]), int(t[4:6]),
+        tzinfo=SHANGHAI_TZ,
+    )
+    return "UNTIL=" + until_local.astimezone(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+
+
+def _normalize_rrule(raw_rrule: str) -> str:
+    """统一 UNTIL 的时区，使其能与带时区的 DTSTART 一起交给 rrulestr"""
+    if "UNTIL" not in raw_rrule.upper():
+        return raw_rrule
+    return _RRULE_UNTIL_RE.sub(_until_to_utc, raw_rrule)
+
+
+def _split_property(line: str) -> Tuple[str, Dict[str, str], str]:
+    """将属性行拆分为 (名称, 参数, 值)，参数值可能带引号并包含冒号"""
+    if '"' not in line:
+        head, _, value = line.partition(":")
+    else:
+        in_quotes = False
+        for i, ch in enumerate(line):
+            if ch == '"':
+                in_quotes = not in_quotes
+            elif ch == ":" and not in_quotes:
+                break
+        else:
+            i = len(line)
+        head, value = line[:i], line[i + 1 :]
+
+    name, *raw_params = head.split(";")
+    params = {}
+    for raw in raw_params:
+        key, _, val = raw.partition("=")
+        params[key.upper()] = val.strip('"')
+    return name.upper(), params, value
+
+
+def _iter_vevents(text: str) -> Iterator[Dict[str, Tuple[Dict[str, str], str]]]:
+    """逐个产出 VEVENT 中需要的属性，跳过嵌套组件（如 VALARM）"""
+    event = None
+    nested = 0
+    for line in _unfold_lines(text):
+        upper = line[:12].upper()
+        if upper.startswith("BEGIN:"):
+            if event is None:
+                if line[6:].strip().upper() == "VEVENT":
+                    event = {}
+            else:
+                nested += 1
+            continue
+        if upper.startswith("END:"):
+            if event is not None:
+                if nested:
+                    nested -= 1
+                else:
+                    yield event
+                    event = None
+            continue
+        if event is None or nested:
+            continue
+
+        name, params, value = _split_property(line)
+        if name in _VEVENT_FIELDS and name not in event:
+            event[name] = (params, value)
+
+
+@functools.lru_cache(maxsize=32)
+def _zone(tzid: Optional[str]) -> tzinfo:
+    """根据 TZID 获取时区，无法识别时按上海时区处理"""
+    if not tzid:
+        return SHANGHAI_TZ
+    try:
+        return ZoneInfo(tzid)
+    except (ZoneInfoNotFoundError, ValueError):
+        return SHANGHAI_TZ
+
+
+def _parse_ics_datetime(params: Dict[str, str], value: str) -> datetime:
+    """解析 DTSTART/DTEND，统一转换为上海时区"""
+    v = value.strip()
+    if params.get("VALUE") == "DATE" or len(v) == 8:
+        return datetime(int(v[0:4]), int(v[4:6]), int(v[6:8]), tzinfo=SHANGHAI_TZ)
+
+    dt = datetime(
+        int(v[0:4]), int(v[4:6]), int(v[6:8]),
+        int(v[9:11]), int(v[11:13]), int(v[13:15]),
+    )
+    if v.endswith("Z"):
+        return dt.replace(tzinfo=timezone.utc).astimezone(SHANGHAI_TZ)
+    return dt.replace(tzinfo=_zone(params.get("TZID"))).astimezone(SHANGHAI_TZ)
+
+
+def _expand_ics(file_path: str, horizon_days: int, today: date) -> List[Course]:
+    """读取 .ics 文件并展开从 today 起 horizon_days 天内的重复事件"""
+    courses = []
+    try:
+        with open(file_path, "r", encoding="utf-8") as f:
+            cal_content = f.read()
+    except (FileNotFoundError, IOError) as e:
+        logger.error(f"无法读取 ICS 文件 {file_path}: {e}")
+        return []
+
+    # 展开窗口对所有事件相同，只计算一次；窗口由缓存键中的日期决定，
+    # 保证同一缓存键得到相同的结果
+    start_of_today_utc = datetime.combine(
+        today, dt_time.min, tzinfo=SHANGHAI_TZ
+    ).astimezone(timezone.utc)
+    # 多留一天余量，覆盖当天结束前的课程
+    future_limit_utc = start_of_today_utc + timedelta(days=horizon_days + 1)
+
+    for event in _iter_vevents(cal_content):
+        if "DTSTART" not in event:
+            continue
+        summary = _unescape_text(event["SUMMARY"][1]) if "SUMMARY" in event else None
+        description = (
+            _unescape_text(event["DESCRIPTION"][1]) if "DESCRIPTION" in event else None
+        )
+        location = (
+            _unescape_text(event["LOCATION"][1]) if "LOCATION" in event else None
+        )
+        dtstart = _parse_ics_datetime(*event["DTSTART"])
+        dtend = _parse_ics_datetime(*event["DTEND"]) if "DTEND" in event else dtstart
+        raw_rrule = event["RRULE"][1] if "RRULE" in event else None
+
+        course_duration = dtend - dtstart
+        duration_seconds = int(course_duration.total_seconds())
+
+        if raw_rrule:
+            dtstart_utc = dtstart.astimezone(timezone.utc)
+            rrule = rrulestr(_normalize_rrule(raw_rrule), dtstart=dtstart_utc)
+
+            for occurrence_utc in rrule.between(
+                start_of_today_utc, future_limit_utc, inc=True
+            ):
+                occurrence_local = occurrence_utc.astimezone(SHANGHAI_TZ)
+                start_ts = int(occurrence_utc.timestamp())
+                courses.append(
+                    Course(
+                        summary,
+                        description,
+                        location,
+                        occurrence_local,
+                        occurrence_local + course_duration,
+                        start_ts,
+                        start_ts + duration_seconds,
+                    )
+                )
+        else:
+            if dtstart.date() >= today:
+                courses.append(
+                    Course(
+                        summary,
+                        description,
+                        location,
+                        dtstart,
+                        dtend,
+                        int(dtstart.timestamp()),
+                        int(dtend.timestamp()),
+                    )
+                )
+    return courses
 
 
 class ICSParser:
     """ICS 和 WakeUp 数据解析器"""
 
     def __init__(self):
-        self.course_cache: Dict[str, List[Dict]] = {}
-
-    def parse_ics_file(self, file_path: str) -> List[Dict]:
-        """解析 .ics 文件并返回课程列表，包括重复事件。使用缓存以提高性能。"""
-        if file_path in self.course_cache:
-            return self.course_cache[file_path]
-
-        courses = []
+        self._http_session: Optional[aiohttp.ClientSession] = None
+
+    def parse_ics_file(
+        self, file_path: Union[str, os.PathLike], horizon_days: int = ICS_HORIZON_DAYS
+    ) -> List[Course]:
+        """解析 .ics 文件并返回课程列表，包括从今天起 horizon_days 天内的重复事件。使用缓存以提高性能。"""
+        # 缓存以字符串路径为键，str 传入时 fspath 原样返回
+        file_path = os.fspath(file_path)
         try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                cal_content = f.read()
-        except (FileNotFoundError, IOError) as e:
+            st = os.stat(file_path)
+        except FileNotFoundError:
+            return []
+        except OSError as e:
             logger.error(f"无法读取 ICS 文件 {file_path}: {e}")
             return []
-
-        cal = Calendar.from_ical(cal_content)
-        shanghai_tz = timezone(timedelta(hours=8))
-        today = datetime.now(shanghai_tz).date()
-
-        for component in cal.walk():
-            if component.name == "VEVENT":
-                summary = component.get("summary")
-                description = component.get("description")
-                location = component.get("location")
-                dtstart = component.get("dtstart").dt
-                dtend = component.get("dtend").dt
-                rrule_str = component.get("rrule")
-
-                if isinstance(dtstart, date) and not isinstance(dtstart, datetime):
-                    dtstart = datetime.combine(dtstart, dt_time.min)
-                if isinstance(dtend, date) and not isinstance(dtend, datetime):
-                    dtend = datetime.combine(dtend, dt_time.min)
-
-                dtstart = (
-                    dtstart.astimezone(shanghai_tz)
-                    if dtstart.tzinfo
-                    else dtstart.replace(tzinfo=shanghai_tz)
-                )
-                dtend = (
-                    dtend.astimezone(shanghai_tz)
-                    if dtend.tzinfo
-                    else dtend.replace(tzinfo=shanghai_tz)
-                )
-
-                course_duration = dtend - dtstart
-
-                if rrule_str:
-                    if "UNTIL" in rrule_str:
-                        until_dt = rrule_str["UNTIL"][0]
-                        if isinstance(until_dt, date) and not isinstance(
-                            until_dt, datetime
-                        ):
-                            until_dt = datetime.combine(until_dt, dt_time.max)
-                        if until_dt.tzinfo is None:
-                            until_dt = until_dt.replace(tzinfo=shanghai_tz)
-                        rrule_str["UNTIL"][0] = until_dt.astimezone(timezone.utc)
-
-                    dtstart_utc = dtstart.astimezone(timezone.utc)
-                    rrule = rrulestr(rrule_str.to_ical().decode(), dtstart=dtstart_utc)
-
-                    start_of_today_utc = datetime.now(timezone.utc).replace(
-                        hour=0, minute=0, second=0, microsecond=0
-                    )
-                    future_limit_utc = start_of_today_utc + timedelta(days=365)
-
-                    for occurrence_utc in rrule.between(
-                        start_of_today_utc, future_limit_utc, inc=True
-                    ):
-                        occurrence_local = occurrence_utc.astimezone(shanghai_tz)
-                        courses.append(
-                            {
-                                "summary": summary,
-                                "description": description,
-                                "location": location,
-                                "start_time": occurrence_local,
-                                "end_time": occurrence_local + course_duration,
-                            }
-                        )
-                else:
-                    if dtstart.date() >= today:
-                        courses.append(
-                            {
-                                "summary": summary,
-                                "description": description,
-                                "location": location,
-                                "start_time": dtstart,
-                                "end_time": dtend,
-                            }
-                        )
-        self.course_cache[file_path] = courses
-        return courses
-
-    def clear_cache(self, file_path: str):
-        """清除指定文件的缓存"""
-        self.course_cache.pop(file_path, None)
+        today_ordinal = datetime.now(SHANGHAI_TZ).date().toordinal()
+        return _parse_ics_cached(
+            file_path, st.st_mtime_ns, st.st_size, horizon_days, today_ordinal
+        )
+
+    def get_courses_on(
+        self, file_path: Union[str, os.PathLike], target_date: date
+    ) -> Optional[List[Course]]:
+        """获取指定日期按开始时间排序的课程列表，只展开到该日期为止的重复事件；文件不存在或无法读取时返回 None"""
+        file_path = os.fspath(file_path)
+        try:
+            st = os.stat(file_path)
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logger.error(f"无法读取 ICS 文件 {file_path}: {e}")
+            return None
+        today = datetime.now(SHANGHAI_TZ).date()
+        horizon_days = max((target_date - today).days, 0) + 1
+        by_date = _courses_by_date(
+            file_path, st.st_mtime_ns, st.st_size, horizon_days, today.toordinal()
+        )
+        return by_date.get(target_date, [])
 
     def parse_wakeup_token(self, text: str) -> Optional[str]:
         """从文本中解析 WakeUp 分享口令"""
-        match = re.search(r"「([a-f0-9]{32})」", text)
+        # 先用廉价的长度和定界符检查排除绝大多数普通消息
+        if len(text) < _WAKEUP_TOKEN_MIN_LEN or "「" not in text:
+            return None
+        match = _WAKEUP_TOKEN_RE.search(text)
         if match:
             return match.group(1)
         return None
 
+    async def _session(self) -> aiohttp.ClientSession:
+        """获取复用的 HTTP 会话，首次使用时创建"""
+        if self._http_session is None or self._http_session.closed:
+            self._http_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=8, ttl_dns_cache=300, keepalive_timeout=75
+                ),
+                timeout=aiohttp.ClientTimeout(total=15),
+            )
+        return self._http_session
+
+    async def close(self):
+        """关闭 HTTP 会话，插件卸载时调用"""
+        if self._http_session is not None and not self._http_session.closed:
+            await self._http_session.close()
+        self._http_session = None
+
     async def fetch_wakeup_schedule(self, token: str) -> Optional[List]:
         """通过 WakeUp API 获取课程表数据"""
         url = f"https://i.wakeup.fun/share_schedule/get?key={token}"
-        async with aiohttp.ClientSession() as session:
-            try:
-                async with session.get(url) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        if data.get("status") == 1:
-                            # Wakeup 的数据是多个 JSON 对象拼接成的字符串，需要分割
-                            parts = data["data"].strip().split("\n")
-                            json_parts = [json.loads(p) for p in parts]
-                            return json_parts
-                        else:
-                            logger.error(
-                                f"WakeUp API returned error: {data.get('message')}"
-                            )
-                            return None
+        session = await self._session()
+        try:
+            async with session.get(url) as response:
+                if response.status == 200:
+                    data = await response.json()
+                    if data.get("status") == 1:
+                        # Wakeup 的数据是多个 JSON 对象拼接成的字符串，需要分割
+                        parts = data["data"].strip().split("\n")
+                        json_parts = [json.loads(p) for p in parts]
+                        return json_parts
                     else:
                         logger.error(
-                            f"Failed to fetch WakeUp schedule, status code: {response.status}"
+                            f"WakeUp API returned error: {data.get('message')}"
                         )
                         return None
-            except Exception as e:
-                logger.error(f"Error fetching WakeUp schedule: {e}")
-                return None
+                else:
+                    logger.error(
+                        f"Failed to fetch WakeUp schedule, status code: {response.status}"
+                    )
+                    return None
+        except Exception as e:
+            logger.error(f"Error fetching WakeUp schedule: {e}")
+            return None
 
     def convert_wakeup_to_ics(self, data: List) -> Optional[str]:
         """将 WakeUp JSON 数据转换为 ICS 格式"""
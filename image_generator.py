@@ -3,24 +3,56 @@
 本模块负责生成插件所需的各种图片，如图形化课程表和排行榜。
 """
 import asyncio
+import functools
+import hashlib
 import os
-import tempfile
-from datetime import datetime, timezone, timedelta, date
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, date
 from io import BytesIO
+from pathlib import Path
 from typing import Dict, List, Optional
 
 import aiohttp
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageChops, ImageDraw, ImageFont, features
+from PIL import __version__ as PILLOW_VERSION
 
 from astrbot.api import logger
 from . import constants as c
+from .ics_parser import Course
+
+_WEBP_SUPPORTED = features.check("webp")
+
+
+@functools.lru_cache(maxsize=None)
+def _find_font_file(plugin_dir: str) -> str:
+    """在插件目录中查找第一个 .ttf 或 .otf 字体文件"""
+    for filename in os.listdir(plugin_dir):
+        if filename.lower().endswith((".ttf", ".otf")):
+            return os.path.join(plugin_dir, filename)
+    return ""
+
+
+@functools.lru_cache(maxsize=None)
+def _read_font_bytes(path: str) -> bytes:
+    """读取字体文件内容，所有字号共享同一份数据，避免重复读盘"""
+    with open(path, "rb") as f:
+        return f.read()
+
+
+@functools.lru_cache(maxsize=64)
+def _cached_truetype(path: str, size: int) -> ImageFont.FreeTypeFont:
+    """加载并缓存指定路径和大小的 TrueType 字体"""
+    return ImageFont.truetype(BytesIO(_read_font_bytes(path)), size, encoding="utf-8")
 
 
 class ImageGenerator:
     """图片生成器"""
 
     @staticmethod
-    def process_avatar_data(avatar_data: bytes, avatar_size: int, allowed_formats: List[str] | None = None) -> Optional[Image.Image]:
+    def process_avatar_data(avatar_data: bytes, avatar_size: int, allowed_formats: List[str] | None = None, resample: int | None = None) -> Optional[Image.Image]:
         """
         处理头像数据
 
@@ -28,6 +60,7 @@ class ImageGenerator:
             avatar_data: 头像数据字节
             avatar_size: 头像尺寸
             allowed_formats: 允许的图片格式列表
+            resample: 缩放使用的重采样滤波器，默认取 constants.AVATAR_RESAMPLE
 
         Returns:
             处理后的头像图片对象，如果处理失败则返回None
@@ -37,6 +70,8 @@ class ImageGenerator:
 
         if allowed_formats is None:
             allowed_formats = ['JPEG', 'PNG', 'GIF', 'WEBP', 'BMP']
+        if resample is None:
+            resample = getattr(Image, c.AVATAR_RESAMPLE)
 
         try:
             image_stream = BytesIO(avatar_data)
@@ -45,15 +80,23 @@ class ImageGenerator:
                 avatar = Image.open(image_stream)
                 avatar_format = avatar.format
                 if avatar_format in allowed_formats:
+                    if avatar_format == "JPEG":
+                        # 让 JPEG 解码器直接按缩小的尺寸解码，减少后续缩放的像素量
+                        avatar.draft("RGB", (avatar_size * 2, avatar_size * 2))
                     avatar = avatar.convert("RGBA")
-                    avatar = avatar.resize((avatar_size, avatar_size), resample=Image.LANCZOS)
+                    avatar = avatar.resize((avatar_size, avatar_size), resample=resample)
                     return avatar
         except Exception:
             # 如果处理失败，返回None
             pass
         return None
 
-    def __init__(self):
+    def __init__(self, avatar_dir: Optional[Path] = None):
+        # Pillow-SIMD 的版本号带有 .postN 后缀
+        if ".post" in PILLOW_VERSION:
+            logger.info(f"检测到 Pillow-SIMD {PILLOW_VERSION}，图片处理将使用 SIMD 加速。")
+        else:
+            logger.debug(f"当前使用 Pillow {PILLOW_VERSION}，可安装 Pillow-SIMD 以加速图片处理。")
         self.font_path = self._find_font_file()
         self.font_main = self._load_font(32)
         self.font_sub = self._load_font(24)
@@ -65,20 +108,34 @@ class ImageGenerator:
         self.user_font_main = self._load_font(28)
         self.user_font_sub = self._load_font(22)
         self.user_font_title = self._load_font(40)
+        # 以下缓存会在多个渲染线程中读写，统一由该锁保护
+        self._cache_lock = threading.Lock()
+        self._mask_cache: Dict[int, Image.Image] = {}
+        # 预先绘制常用尺寸的圆形遮罩，渲染线程中只需读取
+        for size in {c.GS_AVATAR_SIZE, c.RANKING_AVATAR_SIZE}:
+            self._circle_mask(size)
+        self._probed_chars: Dict[int, set] = {}
+        self._translate_tables: Dict[int, Dict[int, int]] = {}
+        self._sanitized: "OrderedDict[tuple[int, str], str]" = OrderedDict()
+        self._http_session: Optional[aiohttp.ClientSession] = None
+        self._avatar_cache: "OrderedDict[str, tuple[float, bytes]]" = OrderedDict()
+        self._avatar_dir = avatar_dir
+        self._round_avatars: "OrderedDict[tuple, Optional[Image.Image]]" = OrderedDict()
+        self._row_templates: Dict[str, Image.Image] = {}
+        # 渲染使用独立的线程池，不与其他 to_thread 调用（文件读写、课表解析）争用默认线程池
+        self._render_pool = ThreadPoolExecutor(
+            max_workers=c.RENDER_WORKERS, thread_name_prefix="course_schedule_render"
+        )
 
     def _find_font_file(self) -> str:
         """在插件目录中查找第一个 .ttf 或 .otf 字体文件"""
-        plugin_dir = os.path.dirname(__file__)
-        for filename in os.listdir(plugin_dir):
-            if filename.lower().endswith((".ttf", ".otf")):
-                return os.path.join(plugin_dir, filename)
-        return ""
+        return _find_font_file(os.path.dirname(__file__))
 
     def _load_font(self, size: int) -> ImageFont.FreeTypeFont | ImageFont.ImageFont:
         """加载指定大小的字体"""
         try:
             return (
-                ImageFont.truetype(self.font_path, size, encoding="utf-8")
+                _cached_truetype(self.font_path, size)
                 if self.font_path
                 else ImageFont.load_default()
             )
@@ -86,28 +143,101 @@ class ImageGenerator:
             logger.warning(f"无法加载字体文件: {self.font_path}，将使用默认字体。")
             return ImageFont.load_default()
 
+    def _circle_mask(self, size: int) -> Image.Image:
+        """获取指定尺寸的圆形头像遮罩，同一尺寸只绘制一次"""
+        with self._cache_lock:
+            mask = self._mask_cache.get(size)
+        if mask is None:
+            mask = Image.new("L", (size, size), 0)
+            ImageDraw.Draw(mask).ellipse((0, 0, size, size), fill=255)
+            with self._cache_lock:
+                mask = self._mask_cache.setdefault(size, mask)
+        return mask
+
+    def _round_avatar(self, user_id: str, avatar_data: bytes, size: int) -> Optional[Image.Image]:
+        """获取已缩放并裁剪为圆形的头像，按头像内容缓存处理结果"""
+        key = (user_id, size, hashlib.blake2b(avatar_data, digest_size=8).digest())
+        with self._cache_lock:
+            if key in self._round_avatars:
+                self._round_avatars.move_to_end(key)
+                return self._round_avatars[key]
+
+        avatar = self.process_avatar_data(avatar_data, size)
+        if avatar:
+            # 将圆形遮罩合并到 alpha 通道，粘贴时直接以自身作为遮罩
+            alpha = ImageChops.multiply(avatar.getchannel("A"), self._circle_mask(size))
+            avatar.putalpha(alpha)
+        with self._cache_lock:
+            self._round_avatars[key] = avatar
+            if len(self._round_avatars) > c.AVATAR_IMAGE_CACHE_SIZE:
+                self._round_avatars.popitem(last=False)
+        return avatar
+
+    def _schedule_row_template(self, status_bg: str) -> Image.Image:
+        """获取群友课表的行模板（箭头与状态底色块），按状态颜色缓存"""
+        with self._cache_lock:
+            template = self._row_templates.get(status_bg)
+        if template is None:
+            template = Image.new(
+                "RGBA", (c.GS_WIDTH - 2 * c.GS_PADDING, c.GS_ROW_HEIGHT), (0, 0, 0, 0)
+            )
+            draw = ImageDraw.Draw(template)
+            arrow_x = c.GS_AVATAR_SIZE + 20
+            arrow_y = c.GS_ROW_HEIGHT // 2
+            draw.polygon(
+                [
+                    (arrow_x, arrow_y - 20),
+                    (arrow_x + 30, arrow_y),
+                    (arrow_x, arrow_y + 20),
+                ],
+                fill="#BDBDBD",
+            )
+            text_x = arrow_x + 50
+            draw.rectangle([text_x, 60, text_x + 100, 95], fill=status_bg)
+            with self._cache_lock:
+                template = self._row_templates.setdefault(status_bg, template)
+        return template
+
     def _sanitize_for_pil(self, text: str, font: ImageFont.FreeTypeFont | ImageFont.ImageFont) -> str:
-        """移除字体不支持的字符"""
-        sanitized_text = ""
-        for char in text:
-            try:
-                font.getbbox(char)
-                sanitized_text += char
-            except (TypeError, ValueError):
-                sanitized_text += " "
-        return sanitized_text
+        """移除字体不支持的字符，每个字体对同一字符只探测一次"""
+        # 昵称、课程名会在每次渲染中反复出现，直接复用上次的结果
+        key = (id(font), text)
+        # 探测只针对新字符，开销很小，整个过程在锁内完成
+        with self._cache_lock:
+            sanitized = self._sanitized.get(key)
+            if sanitized is not None:
+                self._sanitized.move_to_end(key)
+                return sanitized
+
+            probed = self._probed_chars.setdefault(id(font), set())
+            # 不支持的字符映射为空格，替换由 str.translate 一次完成
+            table = self._translate_tables.setdefault(id(font), {})
+            for char in set(text).difference(probed):
+                try:
+                    font.getbbox(char)
+                except (TypeError, ValueError):
+                    table[ord(char)] = " "
+                probed.add(char)
+            sanitized = text.translate(table)
+            self._sanitized[key] = sanitized
+            if len(self._sanitized) > c.SANITIZE_CACHE_SIZE:
+                self._sanitized.popitem(last=False)
+        return sanitized
 
     def _draw_rounded_rectangle(self, draw, xy, radius, fill):
-        """手动绘制圆角矩形"""
-        x1, y1, x2, y2 = xy
-        draw.rectangle([x1, y1 + radius, x2, y2 - radius], fill=fill)
-        draw.rectangle([x1 + radius, y1, x2 - radius, y2], fill=fill)
-        draw.pieslice([x1, y1, x1 + radius * 2, y1 + radius * 2], 180, 270, fill=fill)
-        draw.pieslice(
-            [x2 - radius * 2, y1, x2, y1 + radius * 2], 270, 360, fill=fill
-        )
-        draw.pieslice([x1, y2 - radius * 2, x1 + radius * 2, y2], 90, 180, fill=fill)
-        draw.pieslice([x2 - radius * 2, y2 - radius * 2, x2, y2], 0, 90, fill=fill)
+        """绘制圆角矩形"""
+        draw.rounded_rectangle(xy, radius=radius, fill=fill)
+
+    @staticmethod
+    def _encode_image(image: Image.Image) -> bytes:
+        """将图片编码为字节数据，直接发送而不经过临时文件"""
+        buf = BytesIO()
+        # 图片只是临时发送用，优先使用编码更快的无损 WebP，并选择最快的编码参数
+        if c.IMAGE_FORMAT == "WEBP" and _WEBP_SUPPORTED:
+            image.save(buf, format="WEBP", lossless=True, quality=80, method=0)
+        else:
+            image.save(buf, format="PNG", optimize=False, compress_level=1)
+        return buf.getvalue()
 
     def _calculate_time_delta(self, start_time: datetime, end_time: datetime, now: datetime, date_type: str) -> tuple[str, str]:
         """
@@ -126,8 +256,8 @@ class ImageGenerator:
             return self._get_finished_status(date_type)
         
         # 计算完整的时间差，包括天数
-        total_seconds_start = int((start_time - now).total_seconds())
-        total_seconds_end = int((end_time - now).total_seconds())
+        total_seconds_start = self._td_seconds(start_time - now)
+        total_seconds_end = self._td_seconds(end_time - now)
         
         if total_seconds_start < 0 <= total_seconds_end:
             # 课程进行中
@@ -145,6 +275,11 @@ class ImageGenerator:
         
         return status_text, detail_text
     
+    @staticmethod
+    def _td_seconds(delta: timedelta) -> int:
+        """将时间差换算为整秒数，直接使用整数字段而不经过浮点运算"""
+        return delta.days * 86400 + delta.seconds
+
     def _format_duration(self, total_minutes: int, prefix: str = "", suffix: str = "") -> str:
         """
         格式化时间持续时间
@@ -157,12 +292,10 @@ class ImageGenerator:
         Returns:
             格式化后的时间文本
         """
+        hours, minutes = divmod(total_minutes, 60)
         if total_minutes > 60:
-            hours = total_minutes // 60
-            minutes = total_minutes % 60
             return f"{prefix}{hours} 小时 {minutes} 分钟{suffix}"
-        else:
-            return f"{prefix}{total_minutes} 分钟{suffix}"
+        return f"{prefix}{total_minutes} 分钟{suffix}"
     
     def _get_finished_status(self, date_type: str) -> tuple[str, str]:
         """
@@ -183,6 +316,67 @@ class ImageGenerator:
             detail_text = f"{date_type}所有课程已结束"
         return status_text, detail_text
 
+    async def _session(self) -> aiohttp.ClientSession:
+        """获取复用的 HTTP 会话，首次使用时创建，保持与头像服务器的连接"""
+        if self._http_session is None or self._http_session.closed:
+            self._http_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=32, ttl_dns_cache=300, keepalive_timeout=75
+                ),
+                timeout=aiohttp.ClientTimeout(total=10),
+                headers={"User-Agent": "astrbot_plugin_CourseSchedule"},
+            )
+        return self._http_session
+
+    async def _run_render(self, func, *args):
+        """在渲染线程池中执行同步的绘图函数"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._render_pool, func, *args)
+
+    async def close(self):
+        """关闭 HTTP 会话和渲染线程池，插件卸载时调用"""
+        if self._http_session is not None and not self._http_session.closed:
+            await self._http_session.close()
+        self._http_session = None
+        self._render_pool.shutdown(wait=False)
+
+    def _avatar_file(self, user_id: str) -> Optional[Path]:
+        """磁盘头像缓存路径，未配置目录或 user_id 不是 QQ 号时返回 None"""
+        if self._avatar_dir is None or not user_id.isdigit():
+            return None
+        return self._avatar_dir / f"{user_id}.jpg"
+
+    def _read_disk_avatar(self, user_id: str) -> Optional[bytes]:
+        """读取未过期的磁盘头像缓存"""
+        path = self._avatar_file(user_id)
+        if path is None:
+            return None
+        try:
+            if time.time() - path.stat().st_mtime >= c.AVATAR_DISK_CACHE_TTL:
+                return None
+            return path.read_bytes()
+        except OSError:
+            return None
+
+    def _write_disk_avatar(self, user_id: str, avatar_data: bytes) -> None:
+        """将下载的头像写入磁盘缓存"""
+        path = self._avatar_file(user_id)
+        if path is None:
+            return
+        tmp_path = path.with_suffix(".tmp")
+        try:
+            tmp_path.write_bytes(avatar_data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Failed to cache avatar for {user_id}: {e}")
+
+    def _remember_avatar(self, user_id: str, fetched_at: float, avatar_data: bytes) -> None:
+        """记录下载或读取到的原始头像，超出数量上限时淘汰最久未使用的条目"""
+        self._avatar_cache[user_id] = (fetched_at, avatar_data)
+        self._avatar_cache.move_to_end(user_id)
+        if len(self._avatar_cache) > c.AVATAR_CACHE_SIZE:
+            self._avatar_cache.popitem(last=False)
+
     async def _fetch_avatars(self, user_ids: List[str]) -> List[Optional[bytes]]:
         """异步获取多个用户的头像"""
 
@@ -215,18 +409,94 @@ class ImageGenerator:
                 logger.warning(f"Unexpected error when fetching avatar for {user_id}: {type(e).__name__} - {e}")
                 return None
 
-        async with aiohttp.ClientSession() as session:
-            tasks = [fetch_avatar(session, user_id) for user_id in user_ids]
-            return await asyncio.gather(*tasks)
+        # 同一用户只下载一次，并复用最近下载过的头像
+        now = time.monotonic()
+        avatars: Dict[str, Optional[bytes]] = {}
+        pending = []
+        for user_id in dict.fromkeys(user_ids):
+            cached = self._avatar_cache.get(user_id)
+            if cached and now - cached[0] < c.AVATAR_CACHE_TTL:
+                self._avatar_cache.move_to_end(user_id)
+                avatars[user_id] = cached[1]
+            else:
+                if cached:
+                    # 过期条目立即移除，不等待被淘汰
+                    del self._avatar_cache[user_id]
+                pending.append(user_id)
+
+        # 内存未命中时先查磁盘缓存，仍未命中的才发起下载
+        if pending:
+            disk_datas = await asyncio.gather(
+                *(asyncio.to_thread(self._read_disk_avatar, user_id) for user_id in pending)
+            )
+            missing = []
+            for user_id, avatar_data in zip(pending, disk_datas):
+                if avatar_data:
+                    avatars[user_id] = avatar_data
+                    self._remember_avatar(user_id, now, avatar_data)
+                else:
+                    missing.append(user_id)
+            pending = missing
+
+        if pending:
+            session = await self._session()
+            tasks = [fetch_avatar(session, user_id) for user_id in pending]
+            downloaded = []
+            for user_id, avatar_data in zip(pending, await asyncio.gather(*tasks)):
+                avatars[user_id] = avatar_data
+                if avatar_data:
+                    self._remember_avatar(user_id, now, avatar_data)
+                    downloaded.append((user_id, avatar_data))
+            if downloaded:
+                await asyncio.gather(
+                    *(
+                        asyncio.to_thread(self._write_disk_avatar, user_id, avatar_data)
+                        for user_id, avatar_data in downloaded
+                    )
+                )
+
+        return [avatars[user_id] for user_id in user_ids]
+
+    async def fetch_avatars(self, user_ids: List[str]) -> Dict[str, Optional[bytes]]:
+        """预先下载一批用户的头像，返回 user_id 到头像数据的映射"""
+        return dict(zip(user_ids, await self._fetch_avatars(user_ids)))
 
-    async def generate_schedule_image(self, courses: List[Dict], date_type: str = "today") -> str:
-        """生成课程表图片并返回临时文件路径
+    async def generate_schedule_image(
+        self,
+        courses: List[Course],
+        date_type: str = "today",
+        avatars: Optional[Dict[str, Optional[bytes]]] = None,
+    ) -> bytes:
+        """生成课程表图片并返回编码后的图片数据
 
         Args:
             courses: 课程列表
             date_type: 日期类型，"today", "tomorrow", 或自定义日期类型如"本周三"等
+            avatars: 已预先下载的头像，为空时在生成图片时下载
         """
-        height = c.GS_PADDING * 2 + 120 + len(courses) * c.GS_ROW_HEIGHT
+        user_ids = [course.user_id or "N/A" for course in courses]
+        if avatars is not None:
+            image = await self._run_render(
+                self._new_schedule_canvas, len(courses), date_type
+            )
+            avatar_datas = [avatars.get(user_id) for user_id in user_ids]
+            return await self._run_render(
+                self._render_schedule_image, image, courses, avatar_datas, date_type
+            )
+
+        # 绘图与编码是同步的 CPU 密集操作，放到渲染线程池中避免阻塞事件循环；
+        # 画布与标题不依赖头像，在下载头像的同时绘制
+        image, avatar_datas = await asyncio.gather(
+            self._run_render(self._new_schedule_canvas, len(courses), date_type),
+            self._fetch_avatars(user_ids),
+        )
+        return await self._run_render(
+            self._render_schedule_image, image, courses, avatar_datas, date_type
+        )
+
+    def _new_schedule_canvas(self, row_count: int, date_type: str) -> Image.Image:
+        """创建群友课程表画布并绘制标题"""
+        height = c.GS_PADDING * 2 + 120 + row_count * c.GS_ROW_HEIGHT
         image = Image.new("RGB", (c.GS_WIDTH, height), c.GS_BG_COLOR)
         draw = ImageDraw.Draw(image)
 
@@ -258,56 +528,51 @@ class ImageGenerator:
             ],
             fill="#A7FFEB",
         )
-
-        user_ids = [course.get("user_id", "N/A") for course in courses]
-        avatar_datas = await self._fetch_avatars(user_ids)
-
+        return image
+
+    def _render_schedule_image(
+        self,
+        image: Image.Image,
+        courses: List[Course],
+        avatar_datas: List[Optional[bytes]],
+        date_type: str,
+    ) -> bytes:
+        """在画布上绘制群友课程并编码为图片数据"""
+        draw = ImageDraw.Draw(image)
         y_offset = c.GS_PADDING + 120
-        now = datetime.now(timezone(timedelta(hours=8)))
+        now = datetime.now(c.SHANGHAI_TZ)
+
+        # 每行相同的坐标只计算一次
+        avatar_dy = (c.GS_ROW_HEIGHT - c.GS_AVATAR_SIZE) // 2
+        text_x = c.GS_PADDING + c.GS_AVATAR_SIZE + 70
 
         for i, course in enumerate(courses):
-            user_id = course.get("user_id", "N/A")
-            nickname = course.get("nickname", user_id)
-            summary = course.get("summary", "无课程信息")
-            start_time: datetime = course.get("start_time")
-            end_time: datetime = course.get("end_time")
+            user_id = course.user_id or "N/A"
+            nickname = course.nickname or user_id
+            summary = course.summary or "无课程信息"
+            start_time = course.start_time
+            end_time = course.end_time
 
             avatar_data = avatar_datas[i]
             if avatar_data:
-                avatar = self.process_avatar_data(avatar_data, c.GS_AVATAR_SIZE)
+                avatar = self._round_avatar(user_id, avatar_data, c.GS_AVATAR_SIZE)
                 if avatar:
-                    # 为头像创建圆形遮罩
-                    mask = Image.new("L", (c.GS_AVATAR_SIZE, c.GS_AVATAR_SIZE), 0)
-                    mask_draw = ImageDraw.Draw(mask)
-                    mask_draw.ellipse(
-                        (0, 0, c.GS_AVATAR_SIZE, c.GS_AVATAR_SIZE), fill=255
-                    )
-                    image.paste(
-                        avatar,
-                        (
-                            c.GS_PADDING,
-                            y_offset + (c.GS_ROW_HEIGHT - c.GS_AVATAR_SIZE) // 2,
-                        ),
-                        mask,
-                    )
+                    image.paste(avatar, (c.GS_PADDING, y_offset + avatar_dy), avatar)
                 else:
                     logger.debug(f"Skipping avatar for user {user_id}: failed to process avatar data")
             else:
                 logger.debug(f"No avatar data available for user {user_id}, skipping avatar display")
 
-            arrow_x = c.GS_PADDING + c.GS_AVATAR_SIZE + 20
-            arrow_y = y_offset + c.GS_ROW_HEIGHT // 2
-            arrow_points = [
-                (arrow_x, arrow_y - 20),
-                (arrow_x + 30, arrow_y),
-                (arrow_x, arrow_y + 20),
-            ]
-            draw.polygon(arrow_points, fill="#BDBDBD")
-
             # 使用重构后的时间计算方法
             status_text, detail_text = self._calculate_time_delta(start_time, end_time, now, date_type)
+            status_bg, status_fg = c.GS_STATUS_COLORS.get(
+                status_text, ("#000000", "#FFFFFF")
+            )
+
+            # 箭头和状态底色块来自预先绘制好的行模板
+            template = self._schedule_row_template(status_bg)
+            image.paste(template, (c.GS_PADDING, y_offset), template)
 
-            text_x = arrow_x + 50
             nickname = self._sanitize_for_pil(nickname, self.font_main)
             draw.text(
                 (text_x, y_offset + 15),
@@ -316,12 +581,6 @@ class ImageGenerator:
                 fill=c.GS_FONT_COLOR,
             )
 
-            status_bg, status_fg = c.GS_STATUS_COLORS.get(
-                status_text, ("#000000", "#FFFFFF")
-            )
-            draw.rectangle(
-                [text_x, y_offset + 60, text_x + 100, y_offset + 95], fill=status_bg
-            )
             draw.text(
                 (text_x + 10, y_offset + 65),
                 status_text,
@@ -355,17 +614,20 @@ class ImageGenerator:
 
             y_offset += c.GS_ROW_HEIGHT
 
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".png")
-        temp_path = temp_file.name
-        image.save(temp_path, format="PNG")
-        temp_file.close()
-
-        return temp_path
+        return self._encode_image(image)
 
     async def generate_user_schedule_image(
-        self, courses: List[Dict], nickname: str, title_suffix: str = "的今日课程"
-    ) -> str:
+        self, courses: List[Course], nickname: str, title_suffix: str = "的今日课程"
+    ) -> bytes:
         """为单个用户生成课程表图片"""
+        return await self._run_render(
+            self._render_user_schedule_image, courses, nickname, title_suffix
+        )
+
+    def _render_user_schedule_image(
+        self, courses: List[Course], nickname: str, title_suffix: str
+    ) -> bytes:
+        """绘制个人课程表图片并编码为图片数据"""
         height = c.US_PADDING * 2 + 100 + len(courses) * c.US_ROW_HEIGHT
         image = Image.new("RGB", (c.US_WIDTH, height), c.US_BG_COLOR)
         draw = ImageDraw.Draw(image)
@@ -381,10 +643,10 @@ class ImageGenerator:
         y_offset = c.US_PADDING + 100
 
         for course in courses:
-            summary = course.get("summary", "无课程信息")
-            start_time = course.get("start_time")
-            end_time = course.get("end_time")
-            location = course.get("location", "未知地点")
+            summary = course.summary or "无课程信息"
+            start_time = course.start_time
+            end_time = course.end_time
+            location = course.location if course.location is not None else "未知地点"
 
             self._draw_rounded_rectangle(
                 draw,
@@ -415,7 +677,7 @@ class ImageGenerator:
 
             y_offset += c.US_ROW_HEIGHT
 
-        footer_text = f"生成时间: {datetime.now().strftime('%Y/%m/%d %H:%M:%S')}"
+        footer_text = f"生成时间: {datetime.now(c.SHANGHAI_TZ).strftime('%Y/%m/%d %H:%M:%S')}"
         draw.text(
             (c.US_PADDING, height - c.US_PADDING),
             footer_text,
@@ -423,20 +685,30 @@ class ImageGenerator:
             fill=c.US_SUBTITLE_COLOR,
         )
 
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".png")
-        temp_path = temp_file.name
-        image.save(temp_path, format="PNG")
-        temp_file.close()
-
-        return temp_path
+        return self._encode_image(image)
 
     async def generate_ranking_image(
         self, ranking_data: List[Dict], start_date: date, end_date: date
-    ) -> str:
+    ) -> bytes:
         """生成排行榜图片"""
+        user_ids = [data["user_id"] for data in ranking_data]
+        image, avatar_datas = await asyncio.gather(
+            self._run_render(
+                self._new_ranking_canvas, len(ranking_data), start_date, end_date
+            ),
+            self._fetch_avatars(user_ids),
+        )
+        return await self._run_render(
+            self._render_ranking_image, image, ranking_data, avatar_datas
+        )
+
+    def _new_ranking_canvas(
+        self, row_count: int, start_date: date, end_date: date
+    ) -> Image.Image:
+        """创建排行榜画布并绘制标题与日期范围"""
         height = (
             c.RANKING_HEADER_HEIGHT
-            + len(ranking_data) * c.RANKING_ROW_HEIGHT
+            + row_count * c.RANKING_ROW_HEIGHT
             + c.RANKING_PADDING
         )
         image = Image.new("RGB", (c.RANKING_WIDTH, height), c.RANKING_BG_COLOR)
@@ -457,11 +729,24 @@ class ImageGenerator:
             font=self.font_subtitle,
             fill=c.RANKING_SUBTITLE_COLOR,
         )
+        return image
+
+    def _render_ranking_image(
+        self,
+        image: Image.Image,
+        ranking_data: List[Dict],
+        avatar_datas: List[Optional[bytes]],
+    ) -> bytes:
+        """在画布上绘制排行榜各行并编码为图片数据"""
+        draw = ImageDraw.Draw(image)
+        y_offset = c.RANKING_HEADER_HEIGHT
 
-        user_ids = [data["user_id"] for data in ranking_data]
-        avatar_datas = await self._fetch_avatars(user_ids)
+        # 每行相同的坐标只计算一次
+        avatar_x = c.RANKING_PADDING + 100
+        avatar_dy = (c.RANKING_ROW_HEIGHT - c.RANKING_AVATAR_SIZE) // 2
+        text_dy = (c.RANKING_ROW_HEIGHT - 30) / 2
+        right_x = c.RANKING_WIDTH - c.RANKING_PADDING - 20
 
-        y_offset = c.RANKING_HEADER_HEIGHT
         for i, data in enumerate(ranking_data):
             rank = i + 1
 
@@ -497,23 +782,11 @@ class ImageGenerator:
 
             avatar_data = avatar_datas[i]
             if avatar_data:
-                avatar = self.process_avatar_data(avatar_data, c.RANKING_AVATAR_SIZE)
+                avatar = self._round_avatar(
+                    data["user_id"], avatar_data, c.RANKING_AVATAR_SIZE
+                )
                 if avatar:
-                    # 为头像创建圆形遮罩
-                    mask = Image.new("L", (c.RANKING_AVATAR_SIZE, c.RANKING_AVATAR_SIZE), 0)
-                    mask_draw = ImageDraw.Draw(mask)
-                    mask_draw.ellipse(
-                        (0, 0, c.RANKING_AVATAR_SIZE, c.RANKING_AVATAR_SIZE), fill=255
-                    )
-                    image.paste(
-                        avatar,
-                        (
-                            c.RANKING_PADDING + 100,
-                            y_offset
-                            + (c.RANKING_ROW_HEIGHT - c.RANKING_AVATAR_SIZE) // 2,
-                        ),
-                        mask,
-                    )
+                    image.paste(avatar, (avatar_x, y_offset + avatar_dy), avatar)
                 else:
                     logger.debug(f"Skipping ranking avatar: failed to process avatar data for user at index {i}")
             else:
@@ -521,7 +794,7 @@ class ImageGenerator:
 
             nickname = self._sanitize_for_pil(data["nickname"], self.font_text)
             draw.text(
-                (c.RANKING_PADDING + 210, y_offset + (c.RANKING_ROW_HEIGHT - 30) / 2),
+                (c.RANKING_PADDING + 210, y_offset + text_dy),
                 nickname,
                 font=self.font_text,
                 fill=c.RANKING_FONT_COLOR,
@@ -539,10 +812,7 @@ class ImageGenerator:
             except (TypeError, ValueError):
                 duration_width = 100
             draw.text(
-                (
-                    c.RANKING_WIDTH - c.RANKING_PADDING - duration_width - 20,
-                    y_offset + (c.RANKING_ROW_HEIGHT - 30) / 2 - 15,
-                ),
+                (right_x - duration_width, y_offset + text_dy - 15),
                 duration_str,
                 font=self.font_text,
                 fill=c.RANKING_FONT_COLOR,
@@ -554,10 +824,7 @@ class ImageGenerator:
             except (TypeError, ValueError):
                 count_width = 80
             draw.text(
-                (
-                    c.RANKING_WIDTH - c.RANKING_PADDING - count_width - 20,
-                    y_offset + (c.RANKING_ROW_HEIGHT - 30) / 2 + 25,
-                ),
+                (right_x - count_width, y_offset + text_dy + 25),
                 count_str,
                 font=self.font_subtitle,
                 fill=c.RANKING_SUBTITLE_COLOR,
@@ -565,8 +832,4 @@ class ImageGenerator:
 
             y_offset += c.RANKING_ROW_HEIGHT
 
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".png")
-        temp_path = temp_file.name
-        image.save(temp_path, format="PNG")
-        temp_file.close()
-        return temp_path
+        return self._encode_image(image)
@@ -1,20 +1,33 @@
+import asyncio
 import os
-import time
-from datetime import datetime, timezone, timedelta
-from typing import Dict
+from dataclasses import dataclass
+from datetime import date, datetime, time as dt_time, timedelta
+from typing import Dict, Optional, Tuple
 
 from astrbot.api import logger
+import astrbot.api.message_components as Comp
 from astrbot.api.event import filter, AstrMessageEvent
 from astrbot.api.event.filter import event_message_type, EventMessageType
 from astrbot.core.star import Star, Context, star_map
 from astrbot.core.utils.io import download_file
 
+from .constants import BIND_TIMEOUT, SHANGHAI_TZ, USER_DATA_FLUSH_DELAY
 from .data_manager import DataManager
 from .ics_parser import ICSParser
 from .image_generator import ImageGenerator
 from .schedule_helper import ScheduleHelper
 
-SHANGHAI_TZ = timezone(timedelta(hours=8))
+
+@dataclass(slots=True)
+class BindingRequest:
+    """一次待完成的课表绑定请求"""
+
+    group_id: str
+    user_id: str
+    nickname: str
+    expiry: Optional[asyncio.TimerHandle] = None
+    claimed: bool = False
+
 
 class Main(Star):
     """课程表插件"""
@@ -24,10 +37,16 @@ class Main(Star):
         self.context = context
         self.data_manager = DataManager(star_map[self.__module__])
         self.ics_parser = ICSParser()
-        self.image_generator = ImageGenerator()
+        self.image_generator = ImageGenerator(self.data_manager.avatar_path)
         self.user_data = self.data_manager.load_user_data()
         self.schedule_helper = ScheduleHelper(self.data_manager, self.ics_parser, self.image_generator, self.user_data)
-        self.binding_requests: Dict[str, Dict] = {}
+        self.binding_requests: Dict[Tuple[str, str], BindingRequest] = {}
+        self._dirty = False
+        self._flush_task: Optional[asyncio.Task] = None
+        self._ranking_cache: Dict[str, Tuple[tuple, bytes]] = {}
+        self._group_user_cache: Dict[str, Tuple[Tuple[str, Dict], ...]] = {}
+        for group_id in self.user_data:
+            self._refresh_group_users(group_id)
 
     @filter.command("绑定课表")
     async def bind_schedule(self, event: AstrMessageEvent):
@@ -41,27 +60,95 @@ class Main(Star):
         nickname = event.get_sender_name()
 
         # 记录绑定请求
-        request_key = f"{group_id}-{user_id}"
-        self.binding_requests[request_key] = {
-            "timestamp": time.time(),
-            "group_id": group_id,
-            "user_id": user_id,
-            "nickname": nickname,
-        }
+        request_key = (group_id, user_id)
+        # 超时的请求会被定时器移除，仍在字典中即表示请求未过期
+        if request_key in self.binding_requests:
+            yield event.plain_result("你已有一个未完成的绑定请求，请先完成或等待超时。")
+            return
+        request = BindingRequest(group_id, user_id, nickname)
+        request.expiry = asyncio.get_running_loop().call_later(
+            BIND_TIMEOUT, self._expire_binding_request, request_key, request
+        )
+        self.binding_requests[request_key] = request
 
         yield event.plain_result(
-            "请在60秒内，在本群内直接发送你的 .ics 文件或 WakeUp 分享口令。"
+            f"请在{BIND_TIMEOUT}秒内，在本群内直接发送你的 .ics 文件或 WakeUp 分享口令。"
         )
 
+    def _refresh_group_users(self, group_id: str) -> None:
+        """重建群内已绑定用户的快照，供群课表指令直接遍历"""
+        users = self.user_data.get(group_id, {}).get("users", {})
+        self._group_user_cache[group_id] = tuple(users.items())
+
+    def _is_current_request(self, request_key: Tuple[str, str], request: BindingRequest) -> bool:
+        """判断绑定请求是否仍然有效（未超时，也未因插件卸载被移除）"""
+        return self.binding_requests.get(request_key) is request
+
+    def _claim_binding_request(self, request: BindingRequest) -> bool:
+        """认领绑定请求并取消超时定时器，使已开始处理的绑定一定能完成并回复
+
+        请求已被另一条消息认领时返回 False。
+        """
+        if request.claimed:
+            return False
+        request.claimed = True
+        if request.expiry is not None:
+            request.expiry.cancel()
+            request.expiry = None
+        return True
+
+    def _release_binding_request(self, request_key: Tuple[str, str], request: BindingRequest):
+        """移除绑定请求并取消其超时定时器，只移除仍是同一次请求的条目"""
+        if not self._is_current_request(request_key, request):
+            return
+        del self.binding_requests[request_key]
+        if request.expiry is not None:
+            request.expiry.cancel()
+            request.expiry = None
+
+    def _expire_binding_request(self, request_key: Tuple[str, str], request: BindingRequest):
+        """绑定请求超时回调"""
+        self._release_binding_request(request_key, request)
+
+    def _mark_dirty(self):
+        """标记用户数据已修改，短时间内的多次修改会合并为一次写入"""
+        self._dirty = True
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        """延迟写入用户数据，写入期间产生的新修改会在下一轮写入"""
+        while self._dirty:
+            await asyncio.sleep(USER_DATA_FLUSH_DELAY)
+            self._dirty = False
+            try:
+                # 在事件循环中序列化快照，避免线程写入时处理器同时修改字典
+                data = self.data_manager.dump_user_data(self.user_data)
+                await asyncio.to_thread(
+                    self.data_manager.save_user_data, self.user_data, data
+                )
+            except asyncio.CancelledError:
+                # 插件卸载时取消，由 terminate 重新保存
+                self._dirty = True
+                raise
+            except Exception as e:
+                # 保留修改标记，下一轮重试，插件卸载时也会再次保存
+                self._dirty = True
+                logger.error(f"保存用户数据失败: {e}")
+
     @event_message_type(EventMessageType.GROUP_MESSAGE)
     async def handle_wakeup_token(self, event: AstrMessageEvent):
         """处理文本消息，检查是否为 WakeUp 口令"""
+        # 绝大多数群消息到达时并没有进行中的绑定请求
+        if not self.binding_requests:
+            return
+
         group_id = event.get_group_id()
         if not group_id:
             return
 
         user_id = event.get_sender_id()
-        request_key = f"{group_id}-{user_id}"
+        request_key = (group_id, user_id)
 
         # 检查是否有绑定请求
         if request_key not in self.binding_requests:
@@ -69,11 +156,6 @@ class Main(Star):
 
         request = self.binding_requests[request_key]
 
-        # 检查是否超时（60秒）
-        if time.time() - request["timestamp"] > 60:
-            del self.binding_requests[request_key]
-            return
-
         # 检查是否为纯文本消息
         if not event.message_str:
             return
@@ -81,25 +163,34 @@ class Main(Star):
         token = self.ics_parser.parse_wakeup_token(event.message_str)
         if not token:
             return
+        if not self._claim_binding_request(request):
+            return
 
+        nickname = request.nickname
         try:
             json_data = await self.ics_parser.fetch_wakeup_schedule(token)
+            # 插件卸载时会移除所有请求，此时丢弃本次结果
+            if not self._is_current_request(request_key, request):
+                return
             if not json_data:
                 yield event.plain_result(
                     "无法获取 WakeUp 课程表数据，请检查口令是否正确或已过期。"
                 )
+                self._release_binding_request(request_key, request)
                 return
 
             ics_content = self.ics_parser.convert_wakeup_to_ics(json_data)
             if not ics_content:
                 yield event.plain_result("课程表数据解析失败，无法生成 ICS 文件。")
+                self._release_binding_request(request_key, request)
                 return
 
-            # 保存 ICS 文件
-            nickname = request.get("nickname", user_id)
-            ics_file_path = self.data_manager.get_ics_file_path(user_id, group_id)
-            with open(ics_file_path, "w", encoding="utf-8") as f:
-                f.write(ics_content)
+            # 保存 ICS 文件，文件写入放到线程中避免阻塞事件循环
+            await asyncio.to_thread(
+                self.data_manager.save_ics_file, user_id, group_id, ics_content
+            )
+            if not self._is_current_request(request_key, request):
+                return
 
             # --- 复用绑定成功逻辑 ---
             if group_id not in self.user_data:
@@ -114,29 +205,33 @@ class Main(Star):
                 "nickname": nickname,
                 "reminder": False,
             }
-            self.data_manager.save_user_data(self.user_data)
+            self._mark_dirty()
+            self._ranking_cache.pop(group_id, None)
+            self._refresh_group_users(group_id)
 
-            # 清除该用户的课表缓存
-            self.ics_parser.clear_cache(str(ics_file_path))
-
-            del self.binding_requests[request_key]
+            self._release_binding_request(request_key, request)
             yield event.plain_result(f"通过 WakeUp 口令绑定课表成功！群号：{group_id}")
 
         except Exception as e:
             logger.error(f"处理 WakeUp 口令失败: {e}")
+            if not self._is_current_request(request_key, request):
+                return
             yield event.plain_result(f"处理 WakeUp 口令失败: {e}")
-            del self.binding_requests[request_key]
+            self._release_binding_request(request_key, request)
 
     @event_message_type(EventMessageType.GROUP_MESSAGE)
     async def handle_file_message(self, event: AstrMessageEvent):
         """处理文件消息，检查是否为课表绑定请求"""
+        if not self.binding_requests:
+            return
+
         # 只处理群消息
         group_id = event.get_group_id()
         if not group_id:
             return
 
         user_id = event.get_sender_id()
-        request_key = f"{group_id}-{user_id}"
+        request_key = (group_id, user_id)
 
         # 检查是否有绑定请求
         if request_key not in self.binding_requests:
@@ -144,24 +239,17 @@ class Main(Star):
 
         request = self.binding_requests[request_key]
 
-        # 检查是否超时（60秒）
-        if time.time() - request["timestamp"] > 60:
-            del self.binding_requests[request_key]
-            return
-
         # 获取消息链中的文件组件
-        messages = event.get_messages()
-        file_component = None
-
-        for message in messages:
-            if hasattr(message, "type") and message.type == "File":
-                file_component = message
-                break
-
-        if not file_component:
+        file_component = next(
+            (m for m in event.get_messages() if getattr(m, "type", None) == "File"),
+            None,
+        )
+        if file_component is None:
+            return
+        if not self._claim_binding_request(request):
             return
 
-        nickname = request.get("nickname", user_id)
+        nickname = request.nickname
         ics_file_path = self.data_manager.get_ics_file_path(user_id, group_id)
 
         try:
@@ -170,26 +258,37 @@ class Main(Star):
             logger.info(f"File component returned path: {file_path}")
 
             if not isinstance(file_path, str) or not file_path.startswith("http"):
-                del self.binding_requests[request_key]
+                self._release_binding_request(request_key, request)
                 return
 
             logger.info(f"Downloading file from URL: {file_path}")
             await download_file(file_path, ics_file_path)
         except Exception as e:
             logger.error(f"获取文件信息失败: {e}")
+            if not self._is_current_request(request_key, request):
+                return
             yield event.plain_result(f"无法获取文件信息，绑定失败。错误：{str(e)}")
-            del self.binding_requests[request_key]
+            self._release_binding_request(request_key, request)
             return
 
         # 检查下载的文件是否存在
-        if not os.path.exists(ics_file_path):
+        try:
+            st = await asyncio.to_thread(os.stat, ics_file_path)
+        except FileNotFoundError:
             logger.error(f"文件下载失败，文件不存在: {ics_file_path}")
+            if not self._is_current_request(request_key, request):
+                return
             yield event.plain_result("文件下载失败，请重试。")
-            del self.binding_requests[request_key]
+            self._release_binding_request(request_key, request)
             return
         logger.info(event.message_obj.raw_message)  # 平台下发的原始消息在这里
         logger.info(f"文件下载成功，文件路径: {ics_file_path}")
-        logger.info(f"文件大小: {os.path.getsize(ics_file_path)} bytes")
+        logger.info(f"文件大小: {st.st_size} bytes")
+
+        # 插件卸载时会移除所有请求，此时丢弃本次结果
+        if not self._is_current_request(request_key, request):
+            return
+        await asyncio.to_thread(self.data_manager.clear_ics_cache, ics_file_path)
 
         # 保存用户数据
         if group_id not in self.user_data:
@@ -202,21 +301,19 @@ class Main(Star):
             "reminder": False,
         }
 
-        self.data_manager.save_user_data(self.user_data)
-
-        # 清除该用户的课表缓存
-        self.ics_parser.clear_cache(str(ics_file_path))
+        self._mark_dirty()
+        self._ranking_cache.pop(group_id, None)
+        self._refresh_group_users(group_id)
 
         # 删除绑定请求
-        del self.binding_requests[request_key]
+        self._release_binding_request(request_key, request)
         yield event.plain_result(f"课表绑定成功！群号：{group_id}")
 
     @filter.command("查看课表")
     async def show_today_schedule(self, event: AstrMessageEvent):
         """查看今天还有什么课"""
         # 使用上海时区 (UTC+8)
-        now = datetime.now(SHANGHAI_TZ)
-        today = now.date()
+        today = self._today()
 
         courses, error_msg = await self.schedule_helper.get_schedule_for_date(event, today, "的今日课程")
 
@@ -224,17 +321,16 @@ class Main(Star):
             yield event.plain_result(error_msg)
             return
 
-        image_path = await self.image_generator.generate_user_schedule_image(
+        image_bytes = await self.image_generator.generate_user_schedule_image(
             courses, event.get_sender_name(), "的今日课程"
         )
-        yield event.image_result(image_path)
+        yield self._image_result(event, image_bytes)
 
     @filter.command("查看明日课表")
     async def show_tomorrow_schedule(self, event: AstrMessageEvent):
         """查看明天还有什么课"""
         # 使用上海时区 (UTC+8)
-        now = datetime.now(SHANGHAI_TZ)
-        tomorrow = now.date() + timedelta(days=1)
+        tomorrow = self._today() + timedelta(days=1)
 
         courses, error_msg = await self.schedule_helper.get_schedule_for_date(event, tomorrow, "的明日课程")
 
@@ -242,41 +338,120 @@ class Main(Star):
             yield event.plain_result(error_msg)
             return
 
-        image_path = await self.image_generator.generate_user_schedule_image(courses, event.get_sender_name(), "的明日课程"
+        image_bytes = await self.image_generator.generate_user_schedule_image(courses, event.get_sender_name(), "的明日课程"
         )
-        yield event.image_result(image_path)
+        yield self._image_result(event, image_bytes)
 
     @filter.command("群友在上什么课")
     async def show_group_now_schedule(self, event: AstrMessageEvent):
         """查看群友接下来有什么课"""
         # 使用上海时区 (UTC+8)
-        now = datetime.now(SHANGHAI_TZ)
-        today = now.date()
+        today = self._today()
 
-        next_courses, error_msg = await self.schedule_helper.get_group_schedule_for_date(event, today, is_today=True)
+        image_bytes, error_msg = await self._render_group_schedule(
+            event, today, is_today=True, date_type="today"
+        )
 
         if error_msg:
             yield event.plain_result(error_msg)
             return
 
-        image_bytes = await self.image_generator.generate_schedule_image(next_courses, date_type="today")
-        yield event.image_result(image_bytes)
+        yield self._image_result(event, image_bytes)
 
     @filter.command("群友明天上什么课")
     async def show_group_tomorrow_schedule(self, event: AstrMessageEvent):
         """查看群友明天有什么课"""
         # 使用上海时区 (UTC+8)
-        now = datetime.now(SHANGHAI_TZ)
-        tomorrow = now.date() + timedelta(days=1)  # 明天的日期
+        tomorrow = self._today() + timedelta(days=1)  # 明天的日期
 
-        next_courses, error_msg = await self.schedule_helper.get_group_schedule_for_date(event, tomorrow, is_today=False)
+        image_bytes, error_msg = await self._render_group_schedule(
+            event, tomorrow, is_today=False, date_type="tomorrow"
+        )
 
         if error_msg:
             yield event.plain_result(error_msg)
             return
 
-        image_bytes = await self.image_generator.generate_schedule_image(next_courses, date_type="tomorrow")
-        yield event.image_result(image_bytes)
+        yield self._image_result(event, image_bytes)
+
+    async def _render_group_schedule(
+        self, event: AstrMessageEvent, target_date: date, is_today: bool, date_type: str
+    ) -> Tuple[Optional[bytes], Optional[str]]:
+        """查询群友课程并生成图片，解析课表的同时预先下载头像"""
+        group_users = self._group_user_cache.get(event.get_group_id())
+        avatar_task = None
+        if group_users:
+            avatar_task = asyncio.create_task(
+                self.image_generator.fetch_avatars([user_id for user_id, _ in group_users])
+            )
+
+        try:
+            next_courses, error_msg = await self.schedule_helper.get_group_schedule_for_date(
+                event, target_date, is_today=is_today, group_users=group_users,
+            )
+            if error_msg:
+                return None, error_msg
+            avatars = await avatar_task if avatar_task else None
+        finally:
+            if avatar_task and not avatar_task.done():
+                avatar_task.cancel()
+
+        image_bytes = await self.image_generator.generate_schedule_image(
+            next_courses, date_type=date_type, avatars=avatars
+        )
+        return image_bytes, None
+
+    @staticmethod
+    def _image_result(event: AstrMessageEvent, image_bytes: bytes):
+        """直接以字节数据发送生成的图片，不经过临时文件"""
+        return event.chain_result([Comp.Image.fromBytes(image_bytes)])
+
+    @staticmethod
+    def _today() -> date:
+        """获取上海时区的当前日期"""
+        return datetime.now(SHANGHAI_TZ).date()
+
+    def _ranking_cache_key(self, group_id: str, group_users: Dict, today: date) -> tuple:
+        """排行榜缓存键：日期与群内每个用户课表文件的修改时间，逐个 stat 文件，应在线程中调用"""
+        stamps = []
+        for user_id in group_users:
+            ics_file_path = self.data_manager.get_ics_file_path(user_id, group_id)
+            try:
+                mtime_ns = os.stat(ics_file_path).st_mtime_ns
+            except OSError:
+                mtime_ns = None
+            stamps.append((user_id, mtime_ns))
+        return today.toordinal(), tuple(stamps)
+
+    def _get_weekly_stats(
+        self,
+        user_id: str,
+        user_info: Dict,
+        group_id: str,
+        week_start_ts: int,
+        week_end_ts: int,
+        horizon_days: int,
+    ) -> Optional[Dict]:
+        """统计单个用户在 [week_start_ts, week_end_ts) 内的上课时长和节数，无课时返回 None"""
+        ics_file_path = self.data_manager.get_ics_file_path(user_id, group_id)
+
+        # 课表文件不存在时解析结果为空，无需再单独检查文件是否存在
+        courses = self.ics_parser.parse_ics_file(ics_file_path, horizon_days)
+        # 直接比较整数时间戳，避免为每节课构造 date 对象
+        durations = [
+            course.end_ts - course.start_ts
+            for course in courses
+            if week_start_ts <= course.start_ts < week_end_ts
+        ]
+
+        if not durations:
+            return None
+        return {
+            "user_id": user_id,
+            "nickname": user_info.get("nickname", user_id),
+            "total_duration": timedelta(seconds=sum(durations)),
+            "course_count": len(durations),
+        }
 
     @filter.command("本周上课排行")
     async def weekly_course_ranking(self, event: AstrMessageEvent):
@@ -286,38 +461,44 @@ class Main(Star):
             yield event.plain_result("本群还没有人绑定课表哦。")
             return
 
-        now = datetime.now(SHANGHAI_TZ)
-        today = now.date()
+        today = self._today()
         start_of_week = today - timedelta(days=today.weekday())
         end_of_week = start_of_week + timedelta(days=6)
+        week_start_ts = int(
+            datetime.combine(start_of_week, dt_time.min, tzinfo=SHANGHAI_TZ).timestamp()
+        )
+        week_end_ts = week_start_ts + 7 * 86400
+        # 解析结果只包含今天及以后的课程，展开到周末即可
+        horizon_days = (end_of_week - today).days + 1
 
-        ranking_data = []
         group_users = self.user_data[group_id].get("users", {})
 
-        for user_id, user_info in group_users.items():
-            ics_file_path = self.data_manager.get_ics_file_path(user_id, group_id)
-            if not os.path.exists(ics_file_path):
-                continue
-
-            courses = self.ics_parser.parse_ics_file(str(ics_file_path))
-            total_duration = timedelta()
-            course_count = 0
-
-            for course in courses:
-                course_date = course["start_time"].date()
-                if start_of_week <= course_date <= end_of_week:
-                    total_duration += course["end_time"] - course["start_time"]
-                    course_count += 1
-
-            if course_count > 0:
-                ranking_data.append(
-                    {
-                        "user_id": user_id,
-                        "nickname": user_info.get("nickname", user_id),
-                        "total_duration": total_duration,
-                        "course_count": course_count,
-                    }
+        # 当天内课表未变化时直接复用上次生成的排行榜图片
+        # 传入副本，避免线程遍历期间新的绑定修改字典
+        cache_key = await asyncio.to_thread(
+            self._ranking_cache_key, group_id, dict(group_users), today
+        )
+        cached = self._ranking_cache.get(group_id)
+        if cached and cached[0] == cache_key:
+            yield self._image_result(event, cached[1])
+            return
+
+        # 每个用户的课表解析互不相关，在线程中并发解析
+        results = await asyncio.gather(
+            *(
+                asyncio.to_thread(
+                    self._get_weekly_stats,
+                    user_id,
+                    user_info,
+                    group_id,
+                    week_start_ts,
+                    week_end_ts,
+                    horizon_days,
                 )
+                for user_id, user_info in group_users.items()
+            )
+        )
+        ranking_data = [data for data in results if data]
 
         if not ranking_data:
             yield event.plain_result("本周大家都没有课呢！")
@@ -326,10 +507,19 @@ class Main(Star):
         # 根据总时长降序排名
         ranking_data.sort(key=lambda x: x["total_duration"], reverse=True)
 
-        image_path = await self.image_generator.generate_ranking_image(
+        image_bytes = await self.image_generator.generate_ranking_image(
             ranking_data, start_of_week, end_of_week
         )
-        yield event.image_result(image_path)
+        self._ranking_cache[group_id] = (cache_key, image_bytes)
+        yield self._image_result(event, image_bytes)
 
     async def terminate(self):
+        for request_key, request in list(self.binding_requests.items()):
+            self._release_binding_request(request_key, request)
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        if self._dirty:
+            self.data_manager.save_user_data(self.user_data)
+        await self.image_generator.close()
+        await self.ics_parser.close()
         logger.info("Course Schedule plugin terminated.")
@@ -1,5 +1,13 @@
-import os
-from datetime import datetime, timezone, timedelta
+import asyncio
+from bisect import bisect_right
+from dataclasses import replace
+from datetime import datetime
+from operator import attrgetter
+
+from .constants import SHANGHAI_TZ
+from .ics_parser import Course
+
+_START_TS = attrgetter("start_ts")
 
 
 
@@ -12,34 +20,39 @@ class ScheduleHelper:
         self.image_generator = image_generator
         self.user_data = user_data
 
+    def _courses_if_bound(self, user_id, group_id, target_date):
+        """读取用户在目标日期的课程，课表文件不存在或无法读取时返回 None
+
+        解析器产出的 Course 总是带有 start_time/end_time 及对应的 start_ts/end_ts。
+        """
+        # 解析器本身需要 stat 文件以校验缓存，不再单独检查文件是否存在
+        ics_file_path = self.data_manager.get_ics_file_path(user_id, group_id)
+        return self.ics_parser.get_courses_on(ics_file_path, target_date)
+
     async def get_schedule_for_date(self, event, target_date, date_description):
         """根据指定日期获取个人课程安排，包含完整的用户验证逻辑"""
         user_id = event.get_sender_id()
         group_id = event.get_group_id()
 
-        if (
-            not group_id
-            or group_id not in self.user_data
-            or user_id not in self.user_data[group_id].get("users", {})
-        ):
+        group = self.user_data.get(group_id) if group_id else None
+        users = group.get("users") if group else None
+        if not users or user_id not in users:
             return None, "你还没有在这个群绑定课表哦，请在群内发送 /绑定课表 指令，然后发送 .ics 文件来绑定。"
 
-        ics_file_path = self.data_manager.get_ics_file_path(user_id, group_id)
-        if not os.path.exists(ics_file_path):
+        # 解析为 CPU 密集操作，放到线程中执行以免阻塞事件循环
+        courses = await asyncio.to_thread(
+            self._courses_if_bound, user_id, group_id, target_date
+        )
+        if courses is None:
             return None, "课表文件不存在，可能已被删除。请重新绑定。"
 
-        courses = self.ics_parser.parse_ics_file(str(ics_file_path))
-
-        target_courses = []
-        for course in courses:
-            if course["start_time"].date() == target_date:
-                # Only filter by current time for today
-                if target_date == datetime.now(timezone(timedelta(hours=8))).date():
-                    if course["start_time"] > datetime.now(timezone(timedelta(hours=8))):
-                        target_courses.append(course)
-                else:
-                    # For future dates, include all courses
-                    target_courses.append(course)
+        # Only filter by current time for today
+        now = datetime.now(SHANGHAI_TZ)
+        now_ts = now.timestamp()
+        is_today = target_date == now.date()
+        # 课程已按开始时间排序，今天只需二分定位第一节尚未开始的课
+        start = bisect_right(courses, now_ts, key=_START_TS) if is_today else 0
+        target_courses = courses[start:]
 
         if not target_courses:
             # Map date_description to short form for error message
@@ -50,27 +63,21 @@ class ScheduleHelper:
             date_str = date_map.get(date_description)
             return None, f"你{date_str}没有课啦！"
 
-        # Sort courses by start time
-        target_courses.sort(key=lambda x: x["start_time"])
-
         # Add nickname to each course for image generation
-        for course in target_courses:
-            nickname = (
-                self.user_data[group_id]["users"]
-                .get(user_id, {})
-                .get("nickname", user_id)
-            )
-            course["nickname"] = nickname
+        # 课程对象被解析缓存共享，复制后再补充昵称
+        nickname = users[user_id].get("nickname", user_id)
+        target_courses = [replace(course, nickname=nickname) for course in target_courses]
 
         return target_courses, None
 
-    async def get_group_schedule_for_date(self, event, target_date, is_today=True):
+    async def get_group_schedule_for_date(self, event, target_date, is_today=True, group_users=None):
         """根据指定日期获取群友课程安排
 
         Args:
             event: 消息事件
             target_date: 目标日期
             is_today: 是否为今天，True时优先显示正在进行的课程，False时显示最早的课程
+            group_users: 预先生成的 (user_id, user_info) 元组，为空时从用户数据中读取
 
         Returns:
             tuple: (课程列表, 错误信息)
@@ -80,93 +87,72 @@ class ScheduleHelper:
             return None, "本群还没有人绑定课表哦。"
 
         # 使用上海时区 (UTC+8)
-        shanghai_tz = timezone(timedelta(hours=8))
-        now = datetime.now(shanghai_tz)
+        now_ts = datetime.now(SHANGHAI_TZ).timestamp()
+        # 有课和无课的用户分开收集，只需对有课的用户排序
         next_courses = []
+        no_course_users = []
 
-        group_users = self.user_data[group_id].get("users", {})
-        for user_id, user_info in group_users.items():
-            nickname = user_info.get("nickname", user_id)
-            ics_file_path = self.data_manager.get_ics_file_path(user_id, group_id)
-            if not os.path.exists(ics_file_path):
-                continue
+        if group_users is None:
+            group_users = tuple(self.user_data[group_id].get("users", {}).items())
+        if not group_users:
+            return None, "本群还没有人绑定课表哦。"
 
-            courses = self.ics_parser.parse_ics_file(str(ics_file_path))
+        # 各用户的课表互不相关，在线程中并发解析目标日期的课程
+        all_courses = await asyncio.gather(
+            *(
+                asyncio.to_thread(self._courses_if_bound, user_id, group_id, target_date)
+                for user_id, _ in group_users
+            )
+        )
 
-            # 筛选目标日期的课程
-            target_date_courses = [
-                c
-                for c in courses
-                if c.get("start_time") and c.get("start_time").date() == target_date
-            ]
+        for (user_id, user_info), target_date_courses in zip(group_users, all_courses):
+            if target_date_courses is None:
+                continue
+            nickname = user_info.get("nickname", user_id)
 
-            user_next_course = None
             if is_today:
-                # 今天的方法：优先找正在进行的课程，否则找接下来的课程
-                user_current_course = None
-                user_future_course = None
-
-                for course in target_date_courses:
-                    start_time = course.get("start_time")
-                    end_time = course.get("end_time")
-
-                    if start_time and end_time:
-                        # 检查是否是正在进行的课程
-                        if start_time <= now < end_time:
-                            user_current_course = course
-                            break  # 找到正在上的课，就不需要再找下一节了
-
-                        # 检查是否是未来的课程
-                        elif start_time > now:
-                            if (
-                                user_future_course is None
-                                or start_time < user_future_course.get("start_time")
-                            ):
-                                user_future_course = course
+                # 今天的方法：优先找正在进行的课程，否则找接下来最早的课程。
+                # 课程已按开始时间排序，二分定位第一节尚未开始的课
+                idx = bisect_right(target_date_courses, now_ts, key=_START_TS)
+                user_current_course = next(
+                    (c for c in reversed(target_date_courses[:idx]) if c.end_ts > now_ts),
+                    None,
+                )
 
                 # 优先显示正在上的课
-                user_next_course = (
-                    user_current_course if user_current_course else user_future_course
+                user_next_course = user_current_course or (
+                    target_date_courses[idx] if idx < len(target_date_courses) else None
                 )
             else:
                 # 明天的方法：找最早的一节课
-                for course in target_date_courses:
-                    start_time = course.get("start_time")
-                    if start_time:
-                        # 找到最早的课程
-                        if user_next_course is None or start_time < user_next_course.get("start_time"):
-                            user_next_course = course
+                user_next_course = target_date_courses[0] if target_date_courses else None
 
             # 无论用户当天是否有课，都为他创建一个条目
             if user_next_course:
-                # 用户有课
-                user_course_copy = {
-                    "summary": user_next_course["summary"],
-                    "description": user_next_course["description"],
-                    "location": user_next_course["location"],
-                    "start_time": user_next_course["start_time"],
-                    "end_time": user_next_course["end_time"],
-                    "user_id": user_id,
-                    "nickname": nickname,
-                }
+                # 用户有课。课程对象被解析缓存共享，复制后再补充用户信息
+                next_courses.append(
+                    replace(user_next_course, user_id=user_id, nickname=nickname)
+                )
             else:
                 # 用户当天没课
                 summary = "今日无课" if is_today else "明日无课"
-                user_course_copy = {
-                    "summary": summary,
-                    "description": "",
-                    "location": "",
-                    "start_time": None,  # 标记为无课
-                    "end_time": None,
-                    "user_id": user_id,
-                    "nickname": nickname,
-                }
-            next_courses.append(user_course_copy)
-
-        if not next_courses:
+                no_course_users.append(
+                    Course(
+                        summary,
+                        "",
+                        "",
+                        None,  # 标记为无课
+                        None,
+                        user_id=user_id,
+                        nickname=nickname,
+                    )
+                )
+
+        if not next_courses and not no_course_users:
             return None, f"群友们{'接下来都没有课啦！' if is_today else '明天都没有课啦！'}"
 
-        # 排序时，将无课的用户（start_time is None）排在最后
-        next_courses.sort(key=lambda x: (x["start_time"] is None, x["start_time"]))
+        # 有课的用户按开始时间排序，无课的用户（start_time is None）排在最后
+        next_courses.sort(key=_START_TS)
+        next_courses.extend(no_course_users)
 
         return next_courses, None
\ No newline at end of file